@@ -1,10 +1,41 @@
 import csv
+import hashlib
 import os
+import pickle
 import sys
 import subprocess
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
+try:
+    import darshan
+    from darshan.backend.cffi_backend import accumulate_records
+except ImportError:
+    darshan = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+# Rows buffered in memory before each flush to the output CSV
+CHUNK_ROWS = 1024
+# Modules whose totals are extracted (as with darshan-parser --total)
+TOTAL_MODULES = ('POSIX', 'MPI-IO', 'STDIO')
+# Reported when the counter behind the tag column is missing
+TAG_MISSING = 'POSIX_PERF_MIBS (for tag)'
+# How each header was resolved for a file, see build_resolution_plan
+ACTION_MISSING, ACTION_DIRECT, ACTION_TOTAL, ACTION_TAG = 0, 1, 2, 3
+# Bump when the counters produced by parse_darshan_file change
+CACHE_VERSION = 1
+
 def get_sample_headers(sample_file):
     """Extract headers from the sample training file"""
     with open(sample_file, 'r') as f:
@@ -12,37 +43,192 @@ def get_sample_headers(sample_file):
         headers = next(reader)
     return headers
 
-def parse_darshan_file(darshan_file, temp_dir):
-    """Parse a single Darshan file and extract all counters"""
-    counters = {}
+def write_rows(csvfile, rows):
+    """Write a 2D array of rows using shortest round-trip float formatting"""
+    # repr() and '\r\n' match what csv.writer produced for the same values
+    csvfile.writelines(','.join(map(repr, row)) + '\r\n' for row in rows.tolist())
+
+def iter_darshan(root):
+    """Recursively yield paths of .darshan files under root
+    
+    Yields the same files in the same order as os.walk: a directory's files
+    come before its subdirectories, unreadable directories are skipped and
+    symlinked directories are not followed.
+    """
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except OSError:
+        return
+    
+    subdirs = []
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            if entry.name.endswith('.darshan'):
+                yield entry.path
+        elif not entry.is_symlink():
+            subdirs.append(entry.path)
+    
+    for path in subdirs:
+        yield from iter_darshan(path)
+
+def get_cache_path(darshan_file, cache_dir, backend):
+    """Cache file for a Darshan log, keyed by (backend, path, mtime, size)
+    
+    darshan_file is expected to be absolute so the key is stable. The
+    backends do not produce identical counters, so each has its own entries.
+    """
+    st = os.stat(darshan_file)
+    key = f"{CACHE_VERSION}|{backend}|{darshan_file}|{st.st_mtime_ns}|{st.st_size}"
+    digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, f"{digest}.pkl")
+
+def prepare_cache_dir(temp_dir):
+    """Create the parse cache under temp_dir, private to the current user
     
-    # Parse total counters
-    total_file = os.path.join(temp_dir, 'parsed_total.txt')
-    cmd = f"darshan-parser --total {darshan_file} > {total_file} 2>/dev/null"
-    ret = subprocess.call(cmd, shell=True)
-    if ret != 0:
+    Cached pickles are loaded back, so the cache is only used when both
+    directories are owned by this user and not writable by anyone else.
+    Returns the cache directory, or None if caching has to be disabled.
+    """
+    cache_dir = os.path.join(temp_dir, 'cache')
+    try:
+        os.makedirs(temp_dir, mode=0o700, exist_ok=True)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    except OSError:
+        print(f"Warning: cannot create {cache_dir}, parse cache disabled")
         return None
+    for path in (temp_dir, cache_dir):
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            print(f"Warning: {path} is shared with other users, parse cache disabled")
+            return None
+    return cache_dir
+
+def parse_darshan_file(darshan_file, cache_dir=None):
+    """Parse a single Darshan file and extract all counters
     
-    with open(total_file, 'r') as f:
-        for line in f:
-            if line.startswith('total'):
-                parts = line.strip().split(':', 1)
-                if len(parts) == 2:
-                    key = parts[0].strip()
-                    value = parts[1].strip()
-                    # Remove 'total_' prefix for POSIX counters
-                    if key.startswith('total_POSIX_'):
-                        key = key.replace('total_', '', 1)
-                    counters[key] = value
+    If cache_dir is given, counters from an earlier run on the unchanged
+    file are reused and fresh results are stored there.
+    """
+    # Prefer reading the log in-process with pydarshan when installed
+    if darshan is not None:
+        parse, backend = read_darshan_report, 'pydarshan'
+    else:
+        parse, backend = run_darshan_parser, 'darshan-parser'
+    if cache_dir is None:
+        return parse(darshan_file)
+    
+    try:
+        cache_file = get_cache_path(darshan_file, cache_dir, backend)
+    except OSError:
+        # The log vanished or is a dangling symlink; skip it as unparsable
+        return None
+    
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Missing, stale or corrupt entries of any kind are cache misses
+        pass
+    
+    counters = parse(darshan_file)
+    if counters is not None:
+        # Write then rename so concurrent workers never see a partial file
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(counters, f, protocol=5)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # A failed cache write must not abort the run
+            pass
+    return counters
+
+def read_darshan_report(darshan_file):
+    """Extract all counters from a Darshan file with pydarshan
+    
+    Produces the same keys as run_darshan_parser: module totals come from
+    the libdarshan-util accumulator that darshan-parser --total uses.
+    """
+    try:
+        report = darshan.DarshanReport(darshan_file, read_all=False)
+    except (OSError, RuntimeError, ValueError):
+        return None
+    
+    # pydarshan ignores a failed job header read and reports nprocs=0
+    if report.metadata['job']['nprocs'] <= 0:
+        return None
+    
+    # Truncated logs (e.g. from killed jobs) open fine but fail on read
+    try:
+        return get_report_counters(report)
+    except (KeyError, IndexError, OSError, RuntimeError, ValueError):
+        # After a failed read libdarshan-util has already released the log
+        # state, and closing it again when the report is collected aborts
+        # the process
+        report.log = None
+        return None
+
+def get_report_counters(report):
+    """Extract the counters from an opened pydarshan report"""
+    nprocs = report.metadata['job']['nprocs']
+    counters = {'nprocs': str(nprocs)}
+    
+    for mod in TOTAL_MODULES:
+        if mod not in report.modules:
+            continue
+        report.mod_read_all_records(mod)
+        rec_dict = report.records[mod].to_df()
+        if rec_dict['counters'].empty:
+            continue
+        
+        acc = accumulate_records(rec_dict, mod, nprocs)
+        summary = acc.summary_record
+        for kind, fmt in (('counters', '{:.0f}'), ('fcounters', '{:f}')):
+            for key, value in summary[kind].iloc[0].drop(['id', 'rank']).items():
+                # POSIX totals are stored without the 'total_' prefix
+                if mod != 'POSIX':
+                    key = f"total_{key}"
+                counters[key] = fmt.format(value)
+        if mod == 'POSIX':
+            counters['POSIX_PERF_MIBS'] = f"{acc.derived_metrics.agg_perf_by_slowest:f}"
     
-    # Parse performance data
-    perf_file = os.path.join(temp_dir, 'parsed_perf.txt')
-    cmd = f"darshan-parser --perf {darshan_file} > {perf_file} 2>/dev/null"
-    subprocess.call(cmd, shell=True)
+    if 'LUSTRE' in report.modules:
+        report.mod_read_all_lustre_records('LUSTRE')
+        lustre = report.records['LUSTRE'].to_df()
+        if 'components' in lustre:
+            # Newer pydarshan exposes stripe layout per file component
+            df = lustre['components']
+            width_col, size_col = 'LUSTRE_COMP_STRIPE_COUNT', 'LUSTRE_COMP_STRIPE_SIZE'
+        else:
+            df = lustre['counters']
+            width_col, size_col = 'LUSTRE_STRIPE_WIDTH', 'LUSTRE_STRIPE_SIZE'
+        if not df.empty:
+            counters['LUSTRE_STRIPE_WIDTH'] = str(int(df[width_col].sum()) // len(df))
+            counters['LUSTRE_STRIPE_SIZE'] = str(int(df[size_col].sum()) // len(df))
     
-    current_module = None
-    with open(perf_file, 'r') as f:
-        for line in f:
+    return counters
+
+def run_darshan_parser(darshan_file):
+    """Extract all counters from a Darshan file with darshan-parser
+    
+    darshan-parser is run once with --base --total --perf and its output
+    is walked line by line for totals, POSIX perf, Lustre and nprocs.
+    """
+    counters = {}
+    lustre_stripe_widths = []
+    lustre_stripe_sizes = []
+    
+    # Stream stdout so parsing overlaps with darshan-parser decoding the log
+    with subprocess.Popen(
+            ["darshan-parser", "--base", "--total", "--perf", darshan_file],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) as proc:
+        current_module = None
+        for line in proc.stdout:
             # Track which module we're in
             if '# POSIX module data' in line:
                 current_module = 'POSIX'
@@ -50,6 +236,15 @@ def parse_darshan_file(darshan_file, temp_dir):
                 current_module = 'MPIIO'
             elif '# STDIO module data' in line:
                 current_module = 'STDIO'
+            elif line.startswith('total'):
+                parts = line.strip().split(':', 1)
+                if len(parts) == 2:
+                    key = parts[0].strip()
+                    value = parts[1].strip()
+                    # Remove 'total_' prefix for POSIX counters
+                    if key.startswith('total_POSIX_'):
+                        key = key.replace('total_', '', 1)
+                    counters[key] = value
             # Extract performance data
             elif 'agg_perf_by_slowest:' in line and current_module == 'POSIX':
                 parts = line.split(':')
@@ -58,40 +253,32 @@ def parse_darshan_file(darshan_file, temp_dir):
                     # Extract just the number (before "# MiB/s")
                     perf_value = perf_str.split('#')[0].strip()
                     counters['POSIX_PERF_MIBS'] = perf_value
+            # Lustre records: <module> <rank> <record id> <counter> <value> ...
+            elif line.startswith('LUSTRE'):
+                parts = line.split('\t')
+                if len(parts) >= 5:
+                    if parts[3] == 'LUSTRE_STRIPE_WIDTH':
+                        lustre_stripe_widths.append(int(parts[4]))
+                    elif parts[3] == 'LUSTRE_STRIPE_SIZE':
+                        lustre_stripe_sizes.append(int(parts[4]))
+            elif line.startswith('# nprocs:'):
+                counters['nprocs'] = line.split(':', 1)[1].strip()
     
-    # Parse Lustre data
-    lustre_file = os.path.join(temp_dir, 'parsed_lustre.txt')
-    cmd = f"darshan-parser {darshan_file} 2>/dev/null | grep '^LUSTRE' | cut -d$'\\t' -f 4-5 > {lustre_file}"
-    subprocess.call(cmd, shell=True)
-    
-    lustre_stripe_widths = []
-    lustre_stripe_sizes = []
-    
-    with open(lustre_file, 'r') as f:
-        for line in f:
-            parts = line.strip().split('\t')
-            if len(parts) >= 2:
-                if parts[0] == 'LUSTRE_STRIPE_WIDTH':
-                    lustre_stripe_widths.append(int(parts[1]))
-                elif parts[0] == 'LUSTRE_STRIPE_SIZE':
-                    lustre_stripe_sizes.append(int(parts[1]))
+    if proc.returncode != 0:
+        return None
     
     if lustre_stripe_widths:
-        counters['LUSTRE_STRIPE_WIDTH'] = str(int(np.mean(lustre_stripe_widths)))
+        counters['LUSTRE_STRIPE_WIDTH'] = str(sum(lustre_stripe_widths) // len(lustre_stripe_widths))
     if lustre_stripe_sizes:
-        counters['LUSTRE_STRIPE_SIZE'] = str(int(np.mean(lustre_stripe_sizes)))
-    
-    # Get nprocs from the file
-    with open(total_file, 'r') as f:
-        for line in f:
-            if line.startswith('# nprocs:'):
-                counters['nprocs'] = line.split(':')[1].strip()
-                break
+        counters['LUSTRE_STRIPE_SIZE'] = str(sum(lustre_stripe_sizes) // len(lustre_stripe_sizes))
     
     return counters
 
 def normalize_value(value):
-    """Apply log10(x+1) normalization"""
+    """Apply log10(x+1) normalization to a single value
+    
+    Scalar fallback; build_row normalizes whole rows at once.
+    """
     try:
         numeric_val = float(value)
         normalized = np.log10(numeric_val + 1)
@@ -99,21 +286,99 @@ def normalize_value(value):
     except (ValueError, TypeError):
         return 0.0
 
-def process_darshan_logs(input_dir, output_csv, sample_csv, temp_dir, log_missing=True):
-    """Process all Darshan logs and create output CSV matching sample format"""
+if njit is not None:
+    @njit(cache=True)
+    def finalize_row(raw, action):
+        """Apply log10(x+1) to a raw row, leaving missing counters at 0"""
+        out = np.empty_like(raw)
+        for i in range(len(raw)):
+            out[i] = 0.0 if action[i] == ACTION_MISSING else np.log10(raw[i] + 1.0)
+        return out
+else:
+    def finalize_row(raw, action):
+        """Apply log10(x+1) to a raw row, leaving missing counters at 0"""
+        out = np.log10(raw + 1.0)
+        out[action == ACTION_MISSING] = 0.0
+        return out
+
+def build_resolution_plan(headers):
+    """Precompute, for each header, the (counter key, action) pairs to try
+    
+    tag is derived from POSIX_PERF_MIBS; every other header is looked up
+    directly and then with the total_ prefix.
+    """
+    return [(h, [("POSIX_PERF_MIBS", ACTION_TAG)]) if h == "tag"
+            else (h, [(h, ACTION_DIRECT), ("total_" + h, ACTION_TOTAL)])
+            for h in headers]
+
+def build_row(counters, plan):
+    """Build a normalized CSV row following the resolution plan
+    
+    Raw values and the action that resolved each one are gathered into
+    arrays and finalize_row applies log10(x+1) to the whole row at once.
+    Returns (row, missing_counters, n_found)
+    """
+    missing_counters = []
+    n_found = 0
+    
+    raw = np.zeros(len(plan), dtype=np.float64)
+    action = np.zeros(len(plan), dtype=np.int32)  # ACTION_MISSING
+    for i, (header, keys) in enumerate(plan):
+        for key, key_action in keys:
+            value = counters.get(key)
+            if value is not None:
+                break
+        
+        if value is None:
+            # Missing value, use 0
+            missing_counters.append(TAG_MISSING if header == 'tag' else header)
+            continue
+        
+        action[i] = key_action
+        n_found += 1
+        # Most counters are integers; int() parses those faster than float()
+        try:
+            raw[i] = int(value)
+        except (ValueError, TypeError):
+            try:
+                raw[i] = float(value)
+            except (ValueError, TypeError):
+                raw[i] = 0.0
+    
+    return finalize_row(raw, action), missing_counters, n_found
+
+def available_cpus():
+    """Number of CPUs this process may run on (e.g. the Slurm allocation)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on every platform
+        return os.cpu_count() or 1
+
+def parse_one(darshan_file, plan, cache_dir):
+    """Worker entry point: parse one Darshan file and build its CSV row"""
+    counters = parse_darshan_file(darshan_file, cache_dir)
+    if counters is None:
+        return None
+    return build_row(counters, plan)
+
+def process_darshan_logs(input_dir, output_csv, sample_csv, temp_dir, log_missing=True, verbose=False):
+    """Process all Darshan logs and create output CSV matching sample format
+    
+    Progress is shown as a single bar unless verbose is set, in which case
+    every file is reported as it is written.
+    """
     
     # Get headers from sample file
     headers = get_sample_headers(sample_csv)
+    plan = build_resolution_plan(headers)
     
-    # Create temp directory
-    os.makedirs(temp_dir, exist_ok=True)
+    # Parsed counters are cached under the temp directory across runs
+    cache_dir = prepare_cache_dir(temp_dir)
     
     # Find all Darshan files
-    darshan_files = []
-    for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith('.darshan'):
-                darshan_files.append(os.path.join(root, file))
+    # Resolved once so every path below is already absolute
+    darshan_files = list(iter_darshan(os.path.abspath(input_dir)))
     
     if not darshan_files:
         print(f"No .darshan files found in {input_dir}")
@@ -123,55 +388,48 @@ def process_darshan_logs(input_dir, output_csv, sample_csv, temp_dir, log_missin
     
     # Track global missing counter statistics
     global_missing_counters = {}
+    failed_files = []
     
-    # Process each file and write to CSV
-    with open(output_csv, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(headers)  # Write header
+    # Parse files in parallel; rows come back in file order
+    worker = partial(parse_one, plan=plan, cache_dir=cache_dir)
+    # Rows are buffered and flushed with write_rows every CHUNK_ROWS rows
+    out_arr = np.zeros((min(CHUNK_ROWS, len(darshan_files)), len(headers)), dtype=np.float64)
+    n_rows = 0
+    with open(output_csv, 'w', newline='') as csvfile, \
+            ProcessPoolExecutor(max_workers=available_cpus()) as ex:
+        csvfile.write(','.join(headers) + '\r\n')  # Write header
         
-        for idx, darshan_file in enumerate(darshan_files):
-            print(f"\nProcessing {idx+1}/{len(darshan_files)}: {os.path.basename(darshan_file)}")
+        results = ex.map(worker, darshan_files, chunksize=4)
+        progress = zip(darshan_files, results)
+        if not verbose and tqdm is not None:
+            progress = tqdm(progress, total=len(darshan_files), unit='log')
+        for idx, (darshan_file, result) in enumerate(progress):
+            if verbose:
+                print(f"\nProcessing {idx+1}/{len(darshan_files)}: {os.path.basename(darshan_file)}")
             
-            # Parse the Darshan file
-            counters = parse_darshan_file(darshan_file, temp_dir)
-            if counters is None:
-                print(f"  Skipping due to parse error")
+            if result is None:
+                failed_files.append(darshan_file)
+                if verbose:
+                    print(f"  Skipping due to parse error")
                 continue
             
-            # Track missing counters for this file
-            missing_counters = []
-            found_counters = []
+            row, missing_counters, n_found = result
+            out_arr[n_rows] = row
+            n_rows += 1
+            if n_rows == len(out_arr):
+                write_rows(csvfile, out_arr)
+                n_rows = 0
             
-            # Create row matching sample headers
-            row = []
-            for header in headers:
-                if header == 'tag':
-                    # tag is derived from POSIX_PERF_MIBS (normalized)
-                    value = counters.get('POSIX_PERF_MIBS', '0')
-                    if 'POSIX_PERF_MIBS' not in counters:
-                        missing_counters.append('POSIX_PERF_MIBS (for tag)')
-                    else:
-                        found_counters.append(f"tag={normalize_value(value):.4f}")
-                    row.append(normalize_value(value))
-                elif header in counters:
-                    # Direct match
-                    found_counters.append(f"{header}={normalize_value(counters[header]):.4f}")
-                    row.append(normalize_value(counters[header]))
-                elif f"total_{header}" in counters:
-                    # Try with total_ prefix
-                    found_counters.append(f"{header}={normalize_value(counters[f'total_{header}']):.4f}")
-                    row.append(normalize_value(counters[f"total_{header}"]))
-                else:
-                    # Missing value, use 0
-                    missing_counters.append(header)
-                    row.append(0.0)
-                    
-                    # Track globally
-                    if header not in global_missing_counters:
-                        global_missing_counters[header] = 0
-                    global_missing_counters[header] += 1
+            # Track globally (the tag is only reported per file)
+            for counter in missing_counters:
+                if counter == TAG_MISSING:
+                    continue
+                if counter not in global_missing_counters:
+                    global_missing_counters[counter] = 0
+                global_missing_counters[counter] += 1
             
-            writer.writerow(row)
+            if not verbose:
+                continue
             
             # Log detailed information if requested
             if log_missing and missing_counters:
@@ -181,11 +439,22 @@ def process_darshan_logs(input_dir, output_csv, sample_csv, temp_dir, log_missin
                 if len(missing_counters) > 10:
                     print(f"    ... and {len(missing_counters)-10} more")
             
-            print(f"  Found {len(found_counters)} counters successfully")
+            print(f"  Found {n_found} counters successfully")
             print(f"  Processed successfully")
+        
+        if n_rows:
+            write_rows(csvfile, out_arr[:n_rows])
     
     print(f"\n{'='*60}")
     print(f"Output written to {output_csv}")
+    print(f"Processed {len(darshan_files) - len(failed_files)}/{len(darshan_files)} files")
+    
+    if failed_files:
+        print(f"\nSkipped {len(failed_files)} files due to parse errors:")
+        for darshan_file in failed_files[:10]:  # Show first 10
+            print(f"    - {darshan_file}")
+        if len(failed_files) > 10:
+            print(f"    ... and {len(failed_files)-10} more")
     
     # Summary of missing counters across all files
     if global_missing_counters:
@@ -194,22 +463,25 @@ def process_darshan_logs(input_dir, output_csv, sample_csv, temp_dir, log_missin
         sorted_missing = sorted(global_missing_counters.items(), key=lambda x: x[1], reverse=True)
         for counter, count in sorted_missing[:20]:  # Show top 20
             print(f"    {counter}: missing in {count}/{len(darshan_files)} files")
-    
-    # Clean up temp directory
-    subprocess.call(f"rm -rf {temp_dir}", shell=True)
 
 def main():
-    if len(sys.argv) < 4:
-        print("Usage: python parser_clean.py <input_dir> <output_csv> <sample_csv> [temp_dir]")
+    # --verbose restores the detailed per-file report
+    verbose = '--verbose' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--verbose']
+    
+    if len(args) < 3:
+        print("Usage: python parser_clean.py [--verbose] <input_dir> <output_csv> <sample_csv> [temp_dir]")
         print("Example: python parser_clean.py ./darshan-logs ./output.csv ./sample_train_100.csv")
+        print("temp_dir holds the parse cache and is kept between runs (default: ~/.cache/aiio/darshan_parse)")
         sys.exit(1)
     
-    input_dir = sys.argv[1]
-    output_csv = sys.argv[2]
-    sample_csv = sys.argv[3]
-    temp_dir = sys.argv[4] if len(sys.argv) > 4 else f"/tmp/darshan_parse_{os.getpid()}"
+    input_dir = args[0]
+    output_csv = args[1]
+    sample_csv = args[2]
+    # The cache persists across runs, so keep it on disk and per user
+    temp_dir = args[3] if len(args) > 3 else os.path.expanduser("~/.cache/aiio/darshan_parse")
     
-    process_darshan_logs(input_dir, output_csv, sample_csv, temp_dir, log_missing=True)
+    process_darshan_logs(input_dir, output_csv, sample_csv, temp_dir, log_missing=True, verbose=verbose)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
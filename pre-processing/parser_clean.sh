@@ -4,6 +4,7 @@
 #SBATCH --account=bdau-delta-cpu
 #SBATCH --nodes=1
 #SBATCH --ntasks=1
+#SBATCH --cpus-per-task=16
 #SBATCH --time=00:10:00
 #SBATCH --output=parse_clean_%j.out
 #SBATCH --error=parse_clean_%j.err
@@ -22,7 +23,8 @@ AIIO_DIR="/work/hdd/bdau/mbanisharifdehkordi/aiio"
 INPUT_DIR="$AIIO_DIR/darshan-logs-for-gnn4io"
 OUTPUT_CSV="$AIIO_DIR/parsed-logs-for-gnn4io/output_clean.csv"
 SAMPLE_CSV="$AIIO_DIR/parsed-logs-for-gnn4io/sample_train_100.csv"
-TEMP_DIR="/tmp/darshan_parse_${SLURM_JOB_ID}"
+# Kept between jobs so unchanged logs are not re-parsed
+TEMP_DIR="$HOME/.cache/aiio/darshan_parse"
 
 # Create output directory if needed
 mkdir -p "$(dirname "$OUTPUT_CSV")"
@@ -44,7 +46,7 @@ echo "Total files to process: $TOTAL_FILES"
 echo "=========================================="
 
 # Run the parser
-python pre-processing/parser_clean.py "$INPUT_DIR" "$OUTPUT_CSV" "$SAMPLE_CSV" "$TEMP_DIR"=
+python pre-processing/parser_clean.py "$INPUT_DIR" "$OUTPUT_CSV" "$SAMPLE_CSV" "$TEMP_DIR"
 PARSER_EXIT=$?
 
 echo "=========================================="
@@ -0,0 +1,195 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import parser_clean
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GOOD_LOG = os.path.join(REPO_DIR, 'darshan-logs-for-gnn4io',
+                        'e2e_pathological_11642889_64procs_1stripe_64kb.darshan')
+SAMPLE_CSV = os.path.join(REPO_DIR, 'sample_train_100.csv')
+
+# Abridged `darshan-parser --base --total --perf` output
+PARSER_OUTPUT = """\
+# darshan log version: 3.41
+# compression method: ZLIB
+# exe: /usr/bin/ior -w -t 64k
+# uid: 1000
+# jobid: 42
+# nprocs: 64
+# run time: 2.5
+
+# *******************************************************
+# POSIX module data
+# *******************************************************
+POSIX\t0\t123\tPOSIX_OPENS\t4\t/scratch/f\t/scratch\tlustre
+total_POSIX_OPENS: 257
+total_POSIX_BYTES_WRITTEN: 1048576
+total_POSIX_F_WRITE_TIME: 1.250000
+
+# performance
+# -----------
+# total_bytes: 1048576
+# agg_perf_by_slowest: 128.903939 # MiB/s
+
+# *******************************************************
+# MPI-IO module data
+# *******************************************************
+total_MPIIO_INDEP_OPENS: 0
+
+# performance
+# -----------
+# agg_perf_by_slowest: 99.000000 # MiB/s
+
+# *******************************************************
+# LUSTRE module data
+# *******************************************************
+LUSTRE\t0\t123\tLUSTRE_STRIPE_WIDTH\t4\t/scratch/f\t/scratch\tlustre
+LUSTRE\t0\t123\tLUSTRE_STRIPE_SIZE\t1048576\t/scratch/f\t/scratch\tlustre
+LUSTRE\t0\t456\tLUSTRE_STRIPE_WIDTH\t1\t/scratch/g\t/scratch\tlustre
+LUSTRE\t0\t456\tLUSTRE_STRIPE_SIZE\t65536\t/scratch/g\t/scratch\tlustre
+"""
+
+EXPECTED_COUNTERS = {
+    'nprocs': '64',
+    'POSIX_OPENS': '257',
+    'POSIX_BYTES_WRITTEN': '1048576',
+    'POSIX_F_WRITE_TIME': '1.250000',
+    'total_MPIIO_INDEP_OPENS': '0',
+    'POSIX_PERF_MIBS': '128.903939',
+    'LUSTRE_STRIPE_WIDTH': '2',
+    'LUSTRE_STRIPE_SIZE': '557056',
+}
+
+STUB_PARSER = """\
+#!{python}
+import sys
+# Only the single combined invocation is supported
+if sys.argv[1:4] != ['--base', '--total', '--perf'] or 'bad' in sys.argv[4]:
+    sys.exit(1)
+sys.stdout.write({output!r})
+"""
+
+@pytest.fixture
+def stub_parser(tmp_path, monkeypatch):
+    """Force the darshan-parser backend and put a stub parser on PATH"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'darshan-parser'
+    stub.write_text(STUB_PARSER.format(python=sys.executable, output=PARSER_OUTPUT))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(parser_clean, 'darshan', None)
+
+    log = tmp_path / 'job.darshan'
+    log.write_bytes(b'')
+    return str(log)
+
+def test_run_darshan_parser_counters(stub_parser):
+    assert parser_clean.run_darshan_parser(stub_parser) == EXPECTED_COUNTERS
+
+def test_build_row_reports_missing_counters():
+    plan = parser_clean.build_resolution_plan(['nprocs', 'POSIX_OPENS', 'POSIX_READS', 'tag'])
+    row, missing, n_found = parser_clean.build_row({'nprocs': '9', 'POSIX_OPENS': '99'}, plan)
+    assert list(row) == [1.0, 2.0, 0.0, 0.0]
+    assert missing == ['POSIX_READS', parser_clean.TAG_MISSING]
+    assert n_found == 2
+
+def test_run_darshan_parser_failure(stub_parser, tmp_path):
+    bad_log = tmp_path / 'bad.darshan'
+    bad_log.write_bytes(b'')
+    assert parser_clean.run_darshan_parser(str(bad_log)) is None
+
+def test_cache_round_trip(stub_parser, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    assert parser_clean.parse_darshan_file(stub_parser, cache_dir) == EXPECTED_COUNTERS
+
+    # A cache hit must not run the parser again
+    def fail(darshan_file):
+        raise AssertionError("parser called on cache hit")
+    monkeypatch.setattr(parser_clean, 'run_darshan_parser', fail)
+    assert parser_clean.parse_darshan_file(stub_parser, cache_dir) == EXPECTED_COUNTERS
+
+def test_corrupt_cache_entry_is_a_miss(stub_parser, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    cache_file = parser_clean.get_cache_path(stub_parser, cache_dir, 'darshan-parser')
+    # Unpickling this raises AttributeError, not UnpicklingError
+    with open(cache_file, 'wb') as f:
+        f.write(b'cbuiltins\nno_such_name\n.')
+    assert parser_clean.parse_darshan_file(stub_parser, cache_dir) == EXPECTED_COUNTERS
+
+def test_uncreatable_cache_dir_disables_cache(tmp_path):
+    blocker = tmp_path / 'blocker'
+    blocker.write_bytes(b'')
+    assert parser_clean.prepare_cache_dir(str(blocker / 'darshan_parse')) is None
+
+def test_cache_key_depends_on_backend(stub_parser, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    assert (parser_clean.get_cache_path(stub_parser, cache_dir, 'pydarshan')
+            != parser_clean.get_cache_path(stub_parser, cache_dir, 'darshan-parser'))
+
+def test_iter_darshan_matches_os_walk(tmp_path):
+    for path in ('z.darshan', 'a/x.darshan', 'a/b/w.darshan', 'c/y.darshan',
+                 'c/notes.txt', 'm.darshan'):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_bytes(b'')
+    os.symlink(tmp_path / 'c', tmp_path / 'linked')
+    os.symlink('/nonexistent', tmp_path / 'stale.darshan')
+
+    expected = [os.path.join(root, name)
+                for root, dirs, files in os.walk(tmp_path)
+                for name in files if name.endswith('.darshan')]
+    assert list(parser_clean.iter_darshan(str(tmp_path))) == expected
+
+def test_iter_darshan_skips_unreadable_dir(tmp_path, monkeypatch):
+    (tmp_path / 'ok.darshan').write_bytes(b'')
+    (tmp_path / 'locked').mkdir()
+    (tmp_path / 'locked' / 'y.darshan').write_bytes(b'')
+
+    scandir = os.scandir
+    def fake_scandir(path):
+        if os.path.basename(path) == 'locked':
+            raise PermissionError(path)
+        return scandir(path)
+    monkeypatch.setattr(parser_clean.os, 'scandir', fake_scandir)
+    assert list(parser_clean.iter_darshan(str(tmp_path))) == [str(tmp_path / 'ok.darshan')]
+
+def test_truncated_log_is_skipped(tmp_path):
+    """A truncated log (e.g. from a killed job) is skipped, not fatal"""
+    pytest.importorskip("darshan")
+    input_dir = tmp_path / 'logs'
+    input_dir.mkdir()
+    shutil.copy(GOOD_LOG, input_dir / 'good.darshan')
+    with open(GOOD_LOG, 'rb') as f:
+        (input_dir / 'truncated.darshan').write_bytes(f.read(3000))
+
+    assert parser_clean.read_darshan_report(str(input_dir / 'truncated.darshan')) is None
+
+    output_csv = tmp_path / 'output.csv'
+    parser_clean.process_darshan_logs(str(input_dir), str(output_csv), SAMPLE_CSV,
+                                      str(tmp_path / 'tmp'))
+
+    # Header plus the row for the good log only
+    lines = output_csv.read_text().splitlines()
+    assert len(lines) == 2
+
+def test_dangling_log_is_skipped(stub_parser, tmp_path):
+    input_dir = tmp_path / 'logs'
+    input_dir.mkdir()
+    shutil.copy(stub_parser, input_dir / 'good.darshan')
+    os.symlink('/nonexistent', input_dir / 'stale.darshan')
+
+    output_csv = tmp_path / 'output.csv'
+    parser_clean.process_darshan_logs(str(input_dir), str(output_csv), SAMPLE_CSV,
+                                      str(tmp_path / 'tmp'))
+
+    # Header plus the row for the good log only
+    lines = output_csv.read_text().splitlines()
+    assert len(lines) == 2